@@ -18,14 +18,14 @@ import subprocess
 import progressbar
 import unicodedata
 import tarfile
+import wave
+import shutil
 
-from threading import RLock
-from multiprocessing.dummy import Pool
-from multiprocessing import cpu_count
+from functools import partial
+from multiprocessing import Pool, cpu_count
 from util.downloader import SIMPLE_BAR
 
 from os import path
-from glob import glob
 
 from util.downloader import maybe_download
 from util.text import Alphabet, validate_label
@@ -39,8 +39,15 @@ ARCHIVE_DIR_NAME = 'African_Accented_French'
 ARCHIVE_NAME = 'African_Accented_French.tar.gz'
 ARCHIVE_URL = 'http://www.openslr.org/resources/57/' + ARCHIVE_NAME
 
+TAR_BUFSIZE = 2 * 1024 * 1024
+POOL_CHUNKSIZE = 64
 
-def _download_and_preprocess_data(target_dir):
+# Common French diacritics, stripped without going through unicodedata
+FR_DIACRITICS_TABLE = str.maketrans('àâäéèêëîïôöùûüÿçÀÂÄÉÈÊËÎÏÔÖÙÛÜŸÇ',
+                                    'aaaeeeeiioouuuycAAAEEEEIIOOUUUYC')
+
+
+def _download_and_preprocess_data(target_dir, normalize=False, alphabet=None):
     # Making path absolute
     target_dir = path.abspath(target_dir)
     # Conditionally download data
@@ -48,7 +55,7 @@ def _download_and_preprocess_data(target_dir):
     # Conditionally extract data
     _maybe_extract(target_dir, ARCHIVE_DIR_NAME, archive_path)
     # Produce CSV files
-    _maybe_convert_sets(target_dir, ARCHIVE_DIR_NAME)
+    _maybe_convert_sets(target_dir, ARCHIVE_DIR_NAME, normalize=normalize, alphabet=alphabet)
 
 def _maybe_extract(target_dir, extracted_data, archive_path):
     # If target_dir/extracted_data does not exist, extract archive in target_dir
@@ -57,21 +64,83 @@ def _maybe_extract(target_dir, extracted_data, archive_path):
         print('No directory "%s" - extracting archive...' % extracted_path)
         if not os.path.isdir(extracted_path):
             os.mkdir(extracted_path)
-        tar = tarfile.open(archive_path)
-        tar.extractall(target_dir)
-        tar.close()
+        if shutil.which('tar') and shutil.which('pigz'):
+            # Native tar fed by a parallel gunzip is much faster than tarfile
+            with subprocess.Popen(['pigz', '-dc', archive_path], stdout=subprocess.PIPE) as pigz:
+                with subprocess.Popen(['tar', '-xf', '-', '-C', target_dir], stdin=pigz.stdout) as tar:
+                    # Only tar should hold the read end, so pigz sees SIGPIPE if tar dies
+                    pigz.stdout.close()
+            for process in (tar, pigz):
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(process.returncode, process.args)
+        else:
+            # Stream the archive through a large read buffer instead of tarfile's
+            # default 10KiB chunks; extraction is purely sequential
+            with open(archive_path, 'rb', buffering=TAR_BUFSIZE) as archive_file:
+                with tarfile.open(fileobj=archive_file, mode='r|gz', bufsize=TAR_BUFSIZE) as tar:
+                    tar.extractall(target_dir)
     else:
         print('Found directory "%s" - not extracting it from archive.' % archive_path)
 
-def _maybe_convert_sets(target_dir, extracted_data):
+def walk_wavs(root_dir):
+    """ Recursively yield the path and size of every WAV file under root_dir """
+    for entry in os.scandir(root_dir):
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_wavs(entry.path)
+        elif entry.name.endswith('.wav'):
+            yield (entry.path, entry.stat().st_size)
+
+def label_filter(label, normalize=False, alphabet=None):
+    if normalize:
+        label = label.strip().translate(FR_DIACRITICS_TABLE)
+        try:
+            label.encode("ascii")
+        except UnicodeEncodeError:
+            label = unicodedata.normalize("NFKD", label) \
+                .encode("ascii", "ignore") \
+                .decode("ascii", "ignore")
+    label = validate_label(label)
+    if alphabet and label:
+        try:
+            alphabet.encode(label)
+        except KeyError:
+            label = None
+    return label
+
+def one_sample(sample, normalize=False, alphabet=None):
+    """ Take a audio file, and optionally convert it to 16kHz WAV """
+    wav_filename, file_size, transcript = sample
+    frames = 0
+    try:
+        with wave.open(wav_filename, mode='rb') as wav_file:
+            frames = wav_file.getnframes()
+    except (OSError, EOFError, wave.Error):
+        file_size = -1
+    label = label_filter(transcript, normalize=normalize, alphabet=alphabet)
+    if file_size == -1:
+        # Excluding samples that failed upon conversion
+        status = 'failed'
+    elif label is None:
+        # Excluding samples that failed on label validation
+        status = 'invalid_label'
+    elif int(frames/SAMPLE_RATE*1000/15/2) < len(str(label)):
+        # Excluding samples that are too short to fit the transcript
+        status = 'too_short'
+    elif frames/SAMPLE_RATE > MAX_SECS:
+        # Excluding very long samples to keep a reasonable batch-size
+        status = 'too_long'
+    else:
+        # This one is good - keep it for the target CSV
+        status = 'ok'
+    return (status, wav_filename, file_size, label, frames)
+
+def _maybe_convert_sets(target_dir, extracted_data, normalize=False, alphabet=None):
     extracted_dir = path.join(target_dir, extracted_data)
     # override existing CSV with normalized one
-    target_csv_template = os.path.join(target_dir, ARCHIVE_DIR_NAME, ARCHIVE_NAME.replace('.tar.gz', '_{}.csv'))
+    target_csv_template = os.path.join(extracted_dir, ARCHIVE_DIR_NAME + '_{}.csv')
     if os.path.isfile(target_csv_template):
         return
 
-    wav_root_dir = os.path.join(extracted_dir)
-
     all_files = [
         'transcripts/train/yaounde/fn_text.txt',
         'transcripts/train/ca16_conv/transcripts.txt',
@@ -84,16 +153,18 @@ def _maybe_convert_sets(target_dir, extracted_data):
 
     transcripts = {}
     for tr in all_files:
-        with open(os.path.join(target_dir, ARCHIVE_DIR_NAME, tr), 'r') as tr_source:
-            for line in tr_source.readlines():
-                line = line.strip()
+        if '.tsv' in tr:
+            sep = '	'
+        else:
+            sep = ' '
 
-                if '.tsv' in tr:
-                    sep = '	'
-                else:
-                    sep = ' '
+        with open(os.path.join(extracted_dir, tr), 'r', newline='') as tr_source:
+            lines = (line.strip() for line in tr_source)
+            for row in csv.reader(lines, delimiter=sep, quoting=csv.QUOTE_NONE):
+                if not row:
+                    continue
 
-                audio = os.path.basename(line.split(sep)[0])
+                audio = os.path.basename(row[0])
 
                 if not ('.wav' in audio):
                     if '.tdf' in audio:
@@ -101,87 +172,60 @@ def _maybe_convert_sets(target_dir, extracted_data):
                     else:
                         audio += '.wav'
 
-                transcript = ' '.join(line.split(sep)[1:])
+                transcript = ' '.join(row[1:])
                 transcripts[audio] = transcript
 
     # Get audiofile path and transcript for each sentence in tsv
+    # Several WAVs may share a basename across subtrees, keep all of them
+    wav_index = {}
+    for record in walk_wavs(extracted_dir):
+        wav_index.setdefault(os.path.basename(record[0]), []).append(record)
     samples = []
-    glob_dir = os.path.join(wav_root_dir, '**/*.wav')
-    for record in glob(glob_dir, recursive=True):
-        record_file = os.path.basename(record)
-        if record_file in transcripts:
-            samples.append((record, transcripts[record_file]))
+    for audio, transcript in transcripts.items():
+        for wav_filename, wav_filesize in wav_index.get(audio, []):
+            samples.append((wav_filename, wav_filesize, transcript))
 
     # Keep track of how many samples are good vs. problematic
     counter = {'all': 0, 'failed': 0, 'invalid_label': 0, 'too_short': 0, 'too_long': 0, 'total_time': 0}
-    lock = RLock()
     num_samples = len(samples)
     rows = []
 
-    def one_sample(sample):
-        """ Take a audio file, and optionally convert it to 16kHz WAV """
-        wav_filename = sample[0]
-        file_size = -1
-        frames = 0
-        if path.exists(wav_filename):
-            file_size = path.getsize(wav_filename)
-            frames = int(subprocess.check_output(['soxi', '-s', wav_filename], stderr=subprocess.STDOUT))
-        label = label_filter(sample[1])
-        with lock:
-            if file_size == -1:
-                # Excluding samples that failed upon conversion
-                counter['failed'] += 1
-            elif label is None:
-                # Excluding samples that failed on label validation
-                counter['invalid_label'] += 1
-            elif int(frames/SAMPLE_RATE*1000/15/2) < len(str(label)):
-                # Excluding samples that are too short to fit the transcript
-                counter['too_short'] += 1
-            elif frames/SAMPLE_RATE > MAX_SECS:
-                # Excluding very long samples to keep a reasonable batch-size
-                counter['too_long'] += 1
-            else:
-                # This one is good - keep it for the target CSV
-                rows.append((wav_filename, file_size, label))
-            counter['all'] += 1
-            counter['total_time'] += frames
-
     print("Importing WAV files...")
     pool = Pool(cpu_count())
     bar = progressbar.ProgressBar(max_value=num_samples, widgets=SIMPLE_BAR)
-    for i, _ in enumerate(pool.imap_unordered(one_sample, samples), start=1):
+    # Workers only get module-level state, so the filter settings travel with the task
+    process_sample = partial(one_sample, normalize=normalize, alphabet=alphabet)
+    results = pool.imap_unordered(process_sample, samples, chunksize=POOL_CHUNKSIZE)
+    for i, (status, wav_filename, file_size, label, frames) in enumerate(results, start=1):
+        if status == 'ok':
+            rows.append((wav_filename, file_size, label))
+        else:
+            counter[status] += 1
+        counter['all'] += 1
+        counter['total_time'] += frames
         bar.update(i)
     bar.update(num_samples)
     pool.close()
     pool.join()
 
+    # Split rows by position, 1 in 10 for test and 1 in 10 for dev
+    rows = [(wav_filename, file_size, validate_label(label)) for wav_filename, file_size, label in rows]
+    test_rows = rows[0::10]
+    dev_rows = rows[1::10]
+    train_rows = [row for i, row in enumerate(rows) if i % 10 > 1]
+
     with open(target_csv_template.format('train'), 'w') as train_csv_file:  # 80%
         with open(target_csv_template.format('dev'), 'w') as dev_csv_file:  # 10%
             with open(target_csv_template.format('test'), 'w') as test_csv_file:  # 10%
-                train_writer = csv.DictWriter(train_csv_file, fieldnames=FIELDNAMES)
-                train_writer.writeheader()
-                dev_writer = csv.DictWriter(dev_csv_file, fieldnames=FIELDNAMES)
-                dev_writer.writeheader()
-                test_writer = csv.DictWriter(test_csv_file, fieldnames=FIELDNAMES)
-                test_writer.writeheader()
-
-                for i, item in enumerate(rows):
-                    transcript = validate_label(item[2])
-                    if not transcript:
-                        continue
-                    wav_filename = item[0]
-                    i_mod = i % 10
-                    if i_mod == 0:
-                        writer = test_writer
-                    elif i_mod == 1:
-                        writer = dev_writer
-                    else:
-                        writer = train_writer
-                    writer.writerow(dict(
-                        wav_filename=wav_filename,
-                        wav_filesize=os.path.getsize(wav_filename),
-                        transcript=transcript,
-                    ))
+                train_writer = csv.writer(train_csv_file)
+                train_writer.writerow(FIELDNAMES)
+                dev_writer = csv.writer(dev_csv_file)
+                dev_writer.writerow(FIELDNAMES)
+                test_writer = csv.writer(test_csv_file)
+                test_writer.writerow(FIELDNAMES)
+
+                for writer, split_rows in ((train_writer, train_rows), (dev_writer, dev_rows), (test_writer, test_rows)):
+                    writer.writerows(row for row in split_rows if row[2])
 
     print('Imported %d samples.' % (counter['all'] - counter['failed'] - counter['too_short'] - counter['too_long']))
     if counter['failed'] > 0:
@@ -204,18 +248,4 @@ def handle_args():
 if __name__ == "__main__":
     CLI_ARGS = handle_args()
     ALPHABET = Alphabet(CLI_ARGS.filter_alphabet) if CLI_ARGS.filter_alphabet else None
-
-    def label_filter(label):
-        if CLI_ARGS.normalize:
-            label = unicodedata.normalize("NFKD", label.strip()) \
-                .encode("ascii", "ignore") \
-                .decode("ascii", "ignore")
-        label = validate_label(label)
-        if ALPHABET and label:
-            try:
-                ALPHABET.encode(label)
-            except KeyError:
-                label = None
-        return label
-
-    _download_and_preprocess_data(target_dir=CLI_ARGS.target_dir)
+    _download_and_preprocess_data(target_dir=CLI_ARGS.target_dir, normalize=CLI_ARGS.normalize, alphabet=ALPHABET)
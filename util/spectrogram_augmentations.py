@@ -8,28 +8,24 @@ def augment_freq_time_mask(mel_spectrogram,
     freq_max = tf.shape(mel_spectrogram)[1]
     time_max = tf.shape(mel_spectrogram)[2]
     # Frequency masking
+    freq_range = tf.range(freq_max)
+    freq_mask = tf.ones(shape=[freq_max], dtype=tf.dtypes.bool)
     for _ in range(frequency_mask_num):
         f = tf.random.uniform(shape=(), minval=0, maxval=frequency_masking_para, dtype=tf.dtypes.int32)
         f0 = tf.random.uniform(shape=(), minval=0, maxval=freq_max - f, dtype=tf.dtypes.int32)
-        value_ones_freq_prev = tf.ones(shape=[1, f0, time_max])
-        value_zeros_freq = tf.zeros(shape=[1, f, time_max])
-        value_ones_freq_next = tf.ones(shape=[1, freq_max-(f0+f), time_max])
-        freq_mask = tf.concat([value_ones_freq_prev, value_zeros_freq, value_ones_freq_next], axis=1)
-        #mel_spectrogram[:, f0:f0 + f, :] = 0 #can't assign to tensor
-        #mel_spectrogram[:, f0:f0 + f, :] = value_zeros_freq #can't assign to tensor
-        mel_spectrogram = mel_spectrogram*freq_mask
+        freq_mask = tf.logical_and(freq_mask, tf.logical_or(freq_range < f0, freq_range >= f0 + f))
 
     # Time masking
+    time_range = tf.range(time_max)
+    time_mask = tf.ones(shape=[time_max], dtype=tf.dtypes.bool)
     for _ in range(time_mask_num):
         t = tf.random.uniform(shape=(), minval=0, maxval=time_masking_para, dtype=tf.dtypes.int32)
         t0 = tf.random.uniform(shape=(), minval=0, maxval=time_max - t, dtype=tf.dtypes.int32)
-        value_zeros_time_prev = tf.ones(shape=[1, freq_max, t0])
-        value_zeros_time = tf.zeros(shape=[1, freq_max, t])
-        value_zeros_time_next = tf.ones(shape=[1, freq_max, time_max-(t0+t)])
-        time_mask = tf.concat([value_zeros_time_prev, value_zeros_time, value_zeros_time_next], axis=2)
-        #mel_spectrogram[:, :, t0:t0 + t] = 0 #can't assign to tensor
-        #mel_spectrogram[:, :, t0:t0 + t] = value_zeros_time #can't assign to tensor
-        mel_spectrogram = mel_spectrogram*time_mask
+        time_mask = tf.logical_and(time_mask, tf.logical_or(time_range < t0, time_range >= t0 + t))
+
+    # Apply all masks at once with a single pass over the spectrogram
+    mask = tf.logical_and(freq_mask[:, tf.newaxis], time_mask[tf.newaxis, :])
+    mel_spectrogram = mel_spectrogram*tf.cast(mask, mel_spectrogram.dtype)[tf.newaxis, :, :]
 
     return mel_spectrogram
 
@@ -42,12 +38,11 @@ def augment_pitch_and_tempo(spectrogram,
     choosen_tempo = tf.random.uniform(shape=(), minval=1, maxval=max_tempo)
     new_height = tf.cast(tf.cast(original_shape[1], tf.float32)*choosen_pitch, tf.int32)
     new_width = tf.cast(tf.cast(original_shape[2], tf.float32)/(choosen_tempo), tf.int32)
-    spectrogram_aug = tf.image.resize_bilinear(tf.expand_dims(spectrogram, -1), [new_height, new_width])
+    spectrogram_aug = tf.image.resize(tf.expand_dims(spectrogram, -1), [new_height, new_width], method=tf.image.ResizeMethod.BILINEAR)
     spectrogram_aug = tf.image.crop_to_bounding_box(spectrogram_aug, offset_height=0, offset_width=0, target_height=tf.minimum(original_shape[1], new_height), target_width=tf.shape(spectrogram_aug)[2])
-    spectrogram_aug = tf.cond(choosen_pitch < 1,
-                              lambda: tf.image.pad_to_bounding_box(spectrogram_aug, offset_height=0, offset_width=0,
-                                                                   target_height=original_shape[1], target_width=tf.shape(spectrogram_aug)[2]),
-                              lambda: spectrogram_aug)
+    # Padding to the original height is a no-op when the crop above already got there
+    spectrogram_aug = tf.image.pad_to_bounding_box(spectrogram_aug, offset_height=0, offset_width=0,
+                                                   target_height=original_shape[1], target_width=tf.shape(spectrogram_aug)[2])
     return spectrogram_aug[:, :, :, 0]
 
 
@@ -58,7 +53,7 @@ def augment_speed_up(spectrogram,
     choosen_speed = 1 + choosen_speed
     new_height = tf.cast(tf.cast(original_shape[1], tf.float32), tf.int32)
     new_width = tf.cast(tf.cast(original_shape[2], tf.float32)/(choosen_speed), tf.int32)
-    spectrogram_aug = tf.image.resize_bilinear(tf.expand_dims(spectrogram, -1), [new_height, new_width])
+    spectrogram_aug = tf.image.resize(tf.expand_dims(spectrogram, -1), [new_height, new_width], method=tf.image.ResizeMethod.BILINEAR)
     return spectrogram_aug[:, :, :, 0]
 
 def augment_dropout(spectrogram,